@@ -1,11 +1,18 @@
-import hashlib, time, orjson, json
+import asyncio, hashlib, time, msgspec, orjson
+from collections import OrderedDict
 from datetime import datetime, timezone
 from typing import Optional
 from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi.utils import is_body_allowed_for_status_code
+from pydantic import TypeAdapter, ValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from .schemas import (
     AssessmentEnvelope,
+    AssessmentEnvelopeMsg,
     AssessmentResult,
     Trace,
     TraceStep,
@@ -17,53 +24,143 @@ from .schemas import (
 )
 from .settings import settings
 from .security import require_auth
+from .orjson_response import ORJSONResponse
 
-app = FastAPI(title="Agent Bridge", version="0.0.1")
+app = FastAPI(title="Agent Bridge", version="0.0.1", default_response_class=ORJSONResponse)
+
+_ORIGINS = tuple(o.strip() for o in settings.ALLOW_ORIGINS.split(",") if o.strip())
 
 app.add_middleware(
     CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=settings.ALLOW_ORIGINS.split(","),
-    allow_methods=["*"],
+    # Credentials cannot be combined with a wildcard origin per the CORS spec
+    allow_credentials="*" not in _ORIGINS,
+    allow_origins=list(_ORIGINS),
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
 
+# FastAPI's built-in handlers render errors with the stdlib JSONResponse
+@app.exception_handler(StarletteHTTPException)
+async def _http_exception_handler(req: Request, exc: StarletteHTTPException):
+    headers = getattr(exc, "headers", None)
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
+
+@app.exception_handler(RequestValidationError)
+async def _validation_exception_handler(req: Request, exc: RequestValidationError):
+    return ORJSONResponse({"detail": jsonable_encoder(exc.errors())}, status_code=422)
+
 @app.get("/healthz")
 def healthz():
     return {"ok": True}
 
-def _hash_inputs(env: AssessmentEnvelope) -> str:
-    # Stable hash of the envelope for trace (use aliases so 'schema' appears)
-    b = orjson.dumps(env.model_dump(mode="json", by_alias=True), option=orjson.OPT_SORT_KEYS)
+# Built once so request handlers skip the per-call schema lookup. Envelopes
+# are decoded with msgspec; the pydantic models remain the documented schema.
+# Lax mode keeps accepting numeric strings (e.g. goal targets) like pydantic.
+_ENV_DEC = msgspec.json.Decoder(AssessmentEnvelopeMsg, strict=False)
+_RESULT_ADAPTER = TypeAdapter(AssessmentResult)
+
+
+def _decode_envelope(body: bytes) -> AssessmentEnvelopeMsg:
+    try:
+        return _ENV_DEC.decode(body)
+    except msgspec.DecodeError:
+        pass
+    # Anything msgspec rejects is re-checked against the pydantic model, which
+    # also accepts field names (schema_) and reports errors as a 422
+    try:
+        model = AssessmentEnvelope.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+    return msgspec.convert(model.model_dump(by_alias=True), AssessmentEnvelopeMsg)
+
+
+def _hash_inputs(env: AssessmentEnvelopeMsg) -> str:
+    # Stable hash of the envelope for trace (use aliases so 'schema' appears).
+    # Keys are sorted at every level so free-form dicts (options, figures,
+    # geometry) hash the same regardless of key order. hashlib.sha256 is
+    # OpenSSL's EVP implementation, which picks SHA-NI/ARMv8 SHA at runtime.
+    b = orjson.dumps(msgspec.to_builtins(env), option=orjson.OPT_SORT_KEYS)
     return hashlib.sha256(b).hexdigest()
 
 
+def _run_id(inputs_hash: str) -> str:
+    # Short identifier only; inputs_hash is what carries integrity
+    return hashlib.blake2b(inputs_hash.encode(), digest_size=8).hexdigest()
+
+
+def _run_keys(env: AssessmentEnvelopeMsg) -> tuple[str, str]:
+    # (inputs_hash, run_id). A client_run_id is authoritative: clients that
+    # supply one have already deduplicated, so the envelope is not hashed. It
+    # is used whole as the run id; the schema limits it to 128 header-safe chars.
+    if env.client_run_id:
+        return env.client_run_id, env.client_run_id
+    inputs_hash = _hash_inputs(env)
+    return inputs_hash, _run_id(inputs_hash)
+
+
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+def _json_str(s: str) -> bytes:
+    # Contents of s as a JSON string literal, without the surrounding quotes
+    return orjson.dumps(s)[1:-1]
+
+
+_MAX_DOC_BYTES = 20_000_000
+
+
+async def _read_limited(req: Request, limit: int = _MAX_DOC_BYTES) -> bytes:
+    # Read the body chunk by chunk, rejecting oversized payloads before they
+    # are fully buffered
+    declared = req.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail="Request body too large")
+    buf = bytearray()
+    async for chunk in req.stream():
+        buf += chunk
+        if len(buf) > limit:
+            raise HTTPException(status_code=413, detail="Request body too large")
+    return bytes(buf)
+
+
 # --- Meta ---
 
+_CONSTRAINTS = ["flood_zones", "conservation", "listed_buildings"]
+_POLICY_SCOPES = ["local_plan:2024.10", "national:2023.06"]
+_REPORT_TEMPLATES = [{"id": "default", "fields": ["summary", "policies", "assessment", "conclusion"]}]
+
+# Static payloads are serialized once at import rather than per request
+_META_BYTES = orjson.dumps({
+    "api_version": "1.0.0",
+    "schemas": ["tpa.run/0.2", "tpa.run/0.3"],
+    "constraints_layers": _CONSTRAINTS,
+    "policy_scopes": _POLICY_SCOPES,
+    "report_templates": _REPORT_TEMPLATES,
+    "crs_policy": {"input": "EPSG:4326", "internal": "EPSG:27700", "output": "EPSG:4326"},
+    "supports_vlm": False,
+    "available_models": ["gpt-4o-mini", "llama3.1-70b"],
+    "limits": {"max_doc_bytes": _MAX_DOC_BYTES, "max_geom_vertices": 5000},
+})
+
+_REGISTRY_BYTES = {
+    "constraints": orjson.dumps(_CONSTRAINTS),
+    "policy_scopes": orjson.dumps(_POLICY_SCOPES),
+    "report_templates": orjson.dumps(_REPORT_TEMPLATES),
+}
+
 @app.get("/meta")
 def meta():
-    return {
-        "api_version": "1.0.0",
-        "schemas": ["tpa.run/0.2", "tpa.run/0.3"],
-        "constraints_layers": ["flood_zones", "conservation", "listed_buildings"],
-        "policy_scopes": ["local_plan:2024.10", "national:2023.06"],
-        "report_templates": [{"id": "default", "fields": ["summary", "policies", "assessment", "conclusion"]}],
-        "crs_policy": {"input": "EPSG:4326", "internal": "EPSG:27700", "output": "EPSG:4326"},
-        "supports_vlm": False,
-        "available_models": ["gpt-4o-mini", "llama3.1-70b"],
-        "limits": {"max_doc_bytes": 20_000_000, "max_geom_vertices": 5000},
-    }
+    return Response(content=_META_BYTES, media_type="application/json")
 
-@app.post("/validate", response_model=ValidationResponse)
+@app.post("/validate", responses={200: {"model": ValidationResponse}})
 async def validate(req: Request):
-    body = await req.body()
+    body = await _read_limited(req)
     # New API uses bearer; we permit either bearer or HMAC in dev
     require_auth(req, body)
-    env = AssessmentEnvelope.model_validate_json(body)
+    env = _decode_envelope(body)
     errors: list[ValidationErrorItem] = []
     # Minimal structural checks
     if env.site.geometry is None and env.site.geometry_ref is None:
@@ -71,15 +168,30 @@ async def validate(req: Request):
     # Example: ensure policy_scope strings look non-empty
     if any(not s for s in env.policy_scope):
         errors.append(ValidationErrorItem(path="policy_scope", message="Empty scope entry"))
-    return ValidationResponse(ok=len(errors) == 0, errors=errors)
+    result = ValidationResponse(ok=len(errors) == 0, errors=errors)
+    return Response(content=result.model_dump_json(by_alias=True), media_type="application/json")
+
+# Serialized /assess bodies; the stub pipeline is deterministic on the
+# envelope, so retries and polling replay the bytes. Keys are tagged so a
+# client_run_id can never name another envelope's hash entry.
+_ASSESS_CACHE: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+_ASSESS_CACHE_MAX = 256
 
-@app.post("/assess", response_model=AssessmentResult)
+@app.post("/assess", responses={200: {"model": AssessmentResult}})
 async def assess(req: Request):
-    body = await req.body()
+    body = await _read_limited(req)
     require_auth(req, body)
-    env = AssessmentEnvelope.model_validate_json(body)
+    env = _decode_envelope(body)
     t0 = time.time()
-    run_id = hashlib.sha1(_hash_inputs(env).encode()).hexdigest()[:16]
+    inputs_hash, run_id = _run_keys(env)
+    cache_key = ("client", inputs_hash) if env.client_run_id else ("hash", inputs_hash)
+    cached = _ASSESS_CACHE.get(cache_key)
+    if cached is not None:
+        _ASSESS_CACHE.move_to_end(cache_key)
+        return Response(content=cached, media_type="application/json", headers={"X-Run-Id": run_id, "X-Cache": "hit"})
+    # One clock read per request, shared by evidence, report and trace
+    now_dt = datetime.now(timezone.utc)
+    now = now_dt.isoformat()
     
     # Generate more realistic mock assessment data
     case_ref = env.case.reference if env.case and hasattr(env.case, "reference") else "UNKNOWN"
@@ -101,7 +213,7 @@ async def assess(req: Request):
                     uri="local_plan://section/h1/extensions",
                     pointer="/residential/rear_extensions",
                     hash=hashlib.md5(b"lp_h1_content").hexdigest(),
-                    captured_at=_now_iso(),
+                    captured_at=now,
                     snippet="Single storey rear extensions shall not exceed 4 meters in depth from the original dwelling...",
                     meta={"section": "H1.2", "page": 45}
                 )
@@ -120,7 +232,7 @@ async def assess(req: Request):
                     uri="local_plan://section/d2/design",
                     pointer="/design/conservation_areas",
                     hash=hashlib.md5(b"lp_d2_content").hexdigest(),
-                    captured_at=_now_iso(),
+                    captured_at=now,
                     snippet="Development within conservation areas must preserve or enhance the character and appearance..."
                 )
             ]
@@ -162,7 +274,7 @@ async def assess(req: Request):
 ## Application Details
 - **Reference**: {case_ref}
 - **Proposal**: Single storey rear extension
-- **Assessment Date**: {datetime.now(timezone.utc).strftime('%d %B %Y')}
+- **Assessment Date**: {now_dt.strftime('%d %B %Y')}
 
 ## Recommendation
 **APPROVE with conditions** (Confidence: 78%)
@@ -215,13 +327,14 @@ Subject to the recommended conditions, the proposal is considered acceptable and
             "site_map": {"type": "application/geo+json", "uri": f"http://agent-bridge:8000/runs/{run_id}/overlays.geojson"}
         },
         trace=Trace(
-            inputs_hash=_hash_inputs(env),
+            inputs_hash=inputs_hash,
+            # Internally built steps are trusted, so skip validation
             steps=[
-                TraceStep(t="retrieve_policy", at=_now_iso(), notes="Validated envelope schema and geometry"),
-                TraceStep(t="retrieve_policy", at=_now_iso(), notes="Retrieved 8 relevant policies from local plan"),
-                TraceStep(t="spatial_query", at=_now_iso(), notes="Queried 5 constraint layers"),
-                TraceStep(t="reason", at=_now_iso(), notes="Generated policy assessment using gpt-4o-mini"),
-                TraceStep(t="report_map", at=_now_iso(), notes="Compiled draft decision report"),
+                TraceStep.model_construct(t="retrieve_policy", at=now, notes="Validated envelope schema and geometry"),
+                TraceStep.model_construct(t="retrieve_policy", at=now, notes="Retrieved 8 relevant policies from local plan"),
+                TraceStep.model_construct(t="spatial_query", at=now, notes="Queried 5 constraint layers"),
+                TraceStep.model_construct(t="reason", at=now, notes="Generated policy assessment using gpt-4o-mini"),
+                TraceStep.model_construct(t="report_map", at=now, notes="Compiled draft decision report"),
             ],
             model_ref="gpt-4o-mini",
             prompt_ref="assess/0.1",
@@ -229,92 +342,115 @@ Subject to the recommended conditions, the proposal is considered acceptable and
             latency_ms=int((time.time() - t0) * 1000),
         ),
     )
-    headers = {"X-Run-Id": run_id}
-    return JSONResponse(content=json.loads(result.model_dump_json()), headers=headers)
-
-@app.post("/notice", response_model=AssessmentResult)
+    content = _RESULT_ADAPTER.dump_json(result, by_alias=True)
+    _ASSESS_CACHE[cache_key] = content
+    if len(_ASSESS_CACHE) > _ASSESS_CACHE_MAX:
+        _ASSESS_CACHE.popitem(last=False)
+    headers = {"X-Run-Id": run_id, "X-Cache": "miss"}
+    return Response(content=content, media_type="application/json", headers=headers)
+
+# Stub bodies are rendered once from the models; handlers only splice in the
+# per-request values (JSON-escaped via _json_str)
+_NOTICE_TPL = _RESULT_ADAPTER.dump_json(AssessmentResult(
+    artifacts={
+        "decision_notice": ArtifactRef(type="text/markdown", uri="s3://example/notice.md"),
+    },
+    draft_report_md="# Decision Notice\n\nStub content.",
+    trace=Trace(inputs_hash="__HASH__", steps=[TraceStep(t="report_map", at="__AT__", notes="stub")]),
+), by_alias=True)
+
+
+@app.post("/notice", responses={200: {"model": AssessmentResult}})
 async def notice(req: Request):
-    body = await req.body()
+    body = await _read_limited(req)
     require_auth(req, body)
-    env = AssessmentEnvelope.model_validate_json(body)
-    result = AssessmentResult(
-        artifacts={
-            "decision_notice": ArtifactRef(type="text/markdown", uri="s3://example/notice.md"),
-        },
-        draft_report_md="# Decision Notice\n\nStub content.",
-        trace=Trace(inputs_hash=_hash_inputs(env), steps=[TraceStep(t="report_map", at=_now_iso(), notes="stub")]),
-    )
-    return result
+    env = _decode_envelope(body)
+    inputs_hash, _ = _run_keys(env)
+    content = _NOTICE_TPL.replace(b"__AT__", _json_str(_now_iso())).replace(b"__HASH__", _json_str(inputs_hash))
+    return Response(content=content, media_type="application/json")
 
 
 # --- Runs (async) ---
 
 @app.post("/runs")
 async def start_run(req: Request):
-    body = await req.body()
+    body = await _read_limited(req)
     require_auth(req, body)
-    env = AssessmentEnvelope.model_validate_json(body)
-    run_id = hashlib.sha1(_hash_inputs(env).encode()).hexdigest()[:16]
+    env = _decode_envelope(body)
+    _, run_id = _run_keys(env)
     headers = {"X-Run-Id": run_id}
     payload = {"run_id": run_id, "status": "queued"}
-    return JSONResponse(status_code=202, content=payload, headers=headers)
+    return ORJSONResponse(status_code=202, content=payload, headers=headers)
+
+
+_RUN_TPL = _RESULT_ADAPTER.dump_json(AssessmentResult(
+    draft_report_md="## Summary\nRun stub for __RID__",
+    trace=Trace(inputs_hash="__RID__", steps=[TraceStep(t="reason", at="__AT__", notes="stub")]),
+), by_alias=True)
 
 
 @app.get("/runs/{run_id}")
 def get_run(run_id: str):
-    # Return a stub result snapshot
-    result = AssessmentResult(
-        draft_report_md="## Summary\nRun stub for {run_id}",
-        trace=Trace(inputs_hash=run_id, steps=[TraceStep(t="reason", at=_now_iso(), notes="stub")]),
-    )
+    # Return a stub result snapshot. __AT__ goes first so a run_id that
+    # happens to contain the placeholder cannot be rewritten.
+    body = _RUN_TPL.replace(b"__AT__", _json_str(_now_iso())).replace(b"__RID__", _json_str(run_id))
     etag = hashlib.md5(run_id.encode()).hexdigest()
     headers = {"ETag": etag, "X-Model-Ref": "stub", "X-KB-Snapshot": "v0"}
-    return JSONResponse(content=json.loads(result.model_dump_json()), headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+_EVENT_FRAMES = [
+    b"event: progress\ndata: " + orjson.dumps(f) + b"\n\n"
+    for f in (
+        {"t": "retrieve_policy", "notes": "start"},
+        {"t": "reason", "notes": "thinking"},
+        {"t": "overlay_emit", "notes": "done"},
+    )
+]
 
 
 @app.get("/runs/{run_id}/events")
 def stream_run_events(run_id: str):
-    def gen():
-        frames = [
-            {"t": "retrieve_policy", "notes": "start"},
-            {"t": "reason", "notes": "thinking"},
-            {"t": "overlay_emit", "notes": "done"},
-        ]
-        for f in frames:
-            yield f"event: progress\n"
-            yield f"data: {json.dumps(f)}\n\n"
-            time.sleep(0.05)
-        yield "event: done\n\n"
+    # Async generator so StreamingResponse iterates it on the event loop
+    # rather than hopping to the threadpool for every chunk
+    async def gen():
+        for frame in _EVENT_FRAMES:
+            yield frame
+            await asyncio.sleep(0.05)
+        yield b"event: done\n\n"
 
     return StreamingResponse(gen(), media_type="text/event-stream")
 
 
+_OVERLAYS_TPL = orjson.dumps({
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "properties": {"layer": "ai_inferences", "run_id": "__RID__"},
+            "geometry": {"type": "Point", "coordinates": [0.0, 51.0]},
+        }
+    ],
+})
+
+
 @app.get("/runs/{run_id}/overlays.geojson")
 def get_overlays_geojson(run_id: str, layers: Optional[str] = None):
-    fc = {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "properties": {"layer": "ai_inferences", "run_id": run_id},
-                "geometry": {"type": "Point", "coordinates": [0.0, 51.0]},
-            }
-        ],
-    }
-    return JSONResponse(content=fc, media_type="application/geo+json")
+    body = _OVERLAYS_TPL.replace(b"__RID__", _json_str(run_id))
+    return Response(content=body, media_type="application/geo+json")
 
 
 # --- Reports ---
 
 @app.post("/reports")
 async def create_report(req: Request):
-    body = await req.json()
+    body = orjson.loads(await _read_limited(req))
     template_id = body.get("template_id")
     fields = body.get("fields")
     if not template_id or not isinstance(fields, dict):
         raise HTTPException(status_code=400, detail="template_id and fields required")
-    draft_id = hashlib.md5(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:12]
-    return JSONResponse(status_code=201, content={"report_draft_id": draft_id})
+    draft_id = hashlib.blake2b(orjson.dumps(fields, option=orjson.OPT_SORT_KEYS), digest_size=6).hexdigest()
+    return ORJSONResponse(status_code=201, content={"report_draft_id": draft_id})
 
 
 @app.get("/reports/{report_draft_id}")
@@ -341,13 +477,10 @@ def export_report(report_draft_id: str, format: str):  # noqa: A002 (shadow buil
 
 @app.get("/registries/{name}")
 def get_registry(name: str):
-    if name == "constraints":
-        return ["flood_zones", "conservation", "listed_buildings"]
-    if name == "policy_scopes":
-        return ["local_plan:2024.10", "national:2023.06"]
-    if name == "report_templates":
-        return [{"id": "default", "fields": ["summary", "policies", "assessment", "conclusion"]}]
-    raise HTTPException(status_code=404, detail="Not found")
+    body = _REGISTRY_BYTES.get(name)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return Response(content=body, media_type="application/json")
 
 
 # --- Tools ---
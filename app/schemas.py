@@ -1,12 +1,22 @@
-from typing import List, Optional, Dict, Any, Literal
+from typing import Annotated, List, Optional, Dict, Any, Literal
+import msgspec
 from pydantic import BaseModel, Field
 from pydantic import ConfigDict
 
 # Versions supported per the new spec
 SchemaVer = Literal["tpa.run/0.2", "tpa.run/0.3"]
 
+# client_run_id ends up in the X-Run-Id header and artifact URIs. pydantic's
+# Rust regex treats $ as end of text; msgspec uses Python's re, where $ also
+# matches before a trailing newline, so it needs \Z instead.
+RUN_ID_PATTERN = r"^[A-Za-z0-9._:-]*$"
+RUN_ID_PATTERN_PY = r"^[A-Za-z0-9._:-]*\Z"
+RUN_ID_MAX_LEN = 128
+
 
 class EvidenceLink(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: str
     kind: str
     source_type: Literal["document", "policy", "spatial", "manual"]
@@ -65,11 +75,66 @@ class AssessmentEnvelope(BaseModel):
     goals: List[Goal] = []
     consultation: List[ConsultationItem] = []
     figures: List[Dict[str, Any]] = []
-    client_run_id: Optional[str] = None
+    # When set, used verbatim as trace.inputs_hash and as the run id instead
+    # of hashing the envelope
+    client_run_id: Optional[str] = Field(None, pattern=RUN_ID_PATTERN, max_length=RUN_ID_MAX_LEN)
+    options: Dict[str, Any] = {}
+
+
+# msgspec mirrors of the envelope models, used to decode request bodies on the
+# hot path. Keep these in sync with the pydantic models above.
+
+class CaseMsg(msgspec.Struct):
+    id: str
+    type: str
+    lpa_code: Optional[str] = None
+    reference: Optional[str] = None
+
+
+class SiteMsg(msgspec.Struct):
+    id: str
+    geometry: Optional[Dict[str, Any]] = None
+    crs: Literal["EPSG:4326"] = "EPSG:4326"
+    geometry_ref: Optional[str] = None
+    uprn: Optional[str] = None
+
+
+class DocumentMsg(msgspec.Struct):
+    id: str
+    kind: str
+    uri: str
+    mime: Optional[str] = None
+
+
+class GoalMsg(msgspec.Struct):
+    id: str
+    target: Optional[float] = None
+    weight: float = 1.0
+
+
+class ConsultationItemMsg(msgspec.Struct):
+    id: str
+    topic: Optional[str] = None
+    text_ref: Optional[str] = None
+
+
+class AssessmentEnvelopeMsg(msgspec.Struct, rename={"schema_": "schema"}):
+    schema_: SchemaVer
+    case: CaseMsg
+    site: SiteMsg
+    documents: List[DocumentMsg] = []
+    policy_scope: List[str] = []
+    constraints_layers: List[str] = []
+    goals: List[GoalMsg] = []
+    consultation: List[ConsultationItemMsg] = []
+    figures: List[Dict[str, Any]] = []
+    client_run_id: Optional[Annotated[str, msgspec.Meta(pattern=RUN_ID_PATTERN_PY, max_length=RUN_ID_MAX_LEN)]] = None
     options: Dict[str, Any] = {}
 
 
 class PolicyFinding(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     policy_id: Optional[str] = None
     title: Optional[str] = None
     rag: Optional[Literal["red", "amber", "green", "n/a"]] = None
@@ -80,6 +145,8 @@ class PolicyFinding(BaseModel):
 
 
 class SpatialFinding(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     layer: str
     hit: bool
     impact: Optional[Literal["low", "med", "high"]] = None
@@ -91,12 +158,16 @@ class SpatialFinding(BaseModel):
 
 
 class ChecklistItem(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     item: str
     status: Literal["pass", "fail", "n/a", "needs_review"]
     note: Optional[str] = None
 
 
 class TraceStep(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     t: Literal[
         "retrieve_policy",
         "spatial_query",
@@ -129,11 +200,15 @@ class Trace(BaseModel):
 
 
 class Recommendation(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     outcome: Optional[Literal["approve", "refuse", "seek_changes", "not_applicable"]] = None
     confidence: Optional[float] = None
 
 
 class ArtifactRef(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     type: str
     uri: str
     size_bytes: Optional[int] = None
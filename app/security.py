@@ -11,9 +11,16 @@ import hmac, hashlib
 from fastapi import HTTPException, Request
 from .settings import settings
 
+_KEY = settings.HMAC_SECRET.encode()
+
 def _verify_hmac(raw_body: bytes, signature: str) -> bool:
-    digest = hmac.new(settings.HMAC_SECRET.encode(), raw_body, hashlib.sha256).hexdigest()
-    return hmac.compare_digest(digest, signature)
+    # Compare raw digests so the body MAC is never hex-encoded
+    try:
+        sig_bytes = bytes.fromhex(signature)
+    except ValueError:
+        return False
+    digest = hmac.new(_KEY, raw_body, hashlib.sha256).digest()
+    return hmac.compare_digest(digest, sig_bytes)
 
 def _verify_bearer(auth_header: str) -> bool:
     if not auth_header.startswith("Bearer "):
@@ -32,8 +39,9 @@ def require_auth(req: Request, raw_body: bytes) -> None:
       2. x-signature HMAC if present.
       3. If neither and AUTH_OPTIONAL is False -> 401.
     """
-    authz = req.headers.get("authorization") or req.headers.get("Authorization")
-    sig = req.headers.get("x-signature") or req.headers.get("X-Signature")
+    # Starlette headers are case-insensitive, so one lookup each is enough
+    authz = req.headers.get("authorization")
+    sig = req.headers.get("x-signature")
 
     if authz and _verify_bearer(authz):
         return
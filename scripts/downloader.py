@@ -1,17 +1,37 @@
-import csv, os, time, requests
+import asyncio, csv, logging, os, sys
+from logging.handlers import MemoryHandler
+from operator import itemgetter
+import httpx
+from collections import defaultdict
 from pathlib import Path
 from urllib.parse import urlparse, unquote
 
+log = logging.getLogger("downloader")
+
 UA = {"User-Agent": "TPA-harvester/1.0 (+planning use)"}
+CSV_COLUMNS = ("final_url", "landing_url", "file_kind", "doc_reference", "doc_name",
+               "local_plan", "lpa_curie", "lpa_name")
+REQUIRED_COLUMNS = ("final_url", "landing_url")
+# Values for optional columns the CSV doesn't have
+CSV_DEFAULTS = {"file_kind": "", "doc_reference": "unknown", "doc_name": "document",
+                "local_plan": "", "lpa_curie": "", "lpa_name": ""}
 DOWNLOAD_DIR = Path("downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
+MAX_CONCURRENCY = 16
+MAX_PER_HOST = 4
+WRITE_BATCH = 1 << 20
+FAILURES_LOG = "download_failures.csv"
+PROGRESS_EVERY = 100
+FAILURE_FIELDS = ("doc_reference", "doc_name", "url", "error", "lpa_curie", "lpa_name", "local_plan")
+# Files at least this big are read once downstream, so keep them out of the page cache
+LARGE_FILE_BYTES = 16 << 20
+
+_UNSAFE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
 
 def sanitize_filename(s: str, max_len: int = 200) -> str:
     """Convert string to safe filename"""
-    # Remove/replace unsafe characters
-    unsafe = '<>:"/\\|?*'
-    for char in unsafe:
-        s = s.replace(char, '_')
+    # Replace unsafe characters in a single pass
+    s = s.translate(_UNSAFE_TABLE)
     # Remove leading/trailing spaces and dots
     s = s.strip('. ')
     # Limit length
@@ -45,33 +65,139 @@ def get_filename_from_url(url: str, doc_ref: str, doc_name: str, file_kind: str)
     
     return f"{base}{ext}"
 
-def download_file(url: str, filepath: Path, timeout: int = 120) -> tuple[bool, str]:
+def write_all(fd: int, data) -> None:
+    """os.write until all of data is written (os.write may write partially)."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+# WRITE_BATCH buffers shared by downloads, so unencoded bodies are saved
+# without allocating a new bytes object per batch
+_FREE_BUFFERS: list[bytearray] = []
+
+async def save_raw(r: httpx.Response, fd: int) -> None:
+    """Copy an unencoded response body to fd through a pooled buffer."""
+    buf = _FREE_BUFFERS.pop() if _FREE_BUFFERS else bytearray(WRITE_BATCH)
+    view = memoryview(buf)
+    filled = 0
+    try:
+        async for chunk in r.aiter_raw():
+            chunk = memoryview(chunk)
+            while chunk:
+                take = min(len(chunk), WRITE_BATCH - filled)
+                view[filled:filled + take] = chunk[:take]
+                filled += take
+                chunk = chunk[take:]
+                if filled == WRITE_BATCH:
+                    await asyncio.to_thread(write_all, fd, view)
+                    filled = 0
+        if filled:
+            await asyncio.to_thread(write_all, fd, view[:filled])
+    finally:
+        view.release()
+        _FREE_BUFFERS.append(buf)
+
+def drop_page_cache(filepath: Path) -> None:
+    """Flush a written file and evict it from the page cache (Linux only)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        # DONTNEED only drops clean pages, so write back dirty ones first
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+async def download_file(client: httpx.AsyncClient, url: str, filepath: Path, timeout: int = 120) -> tuple[bool, str]:
     """Download file from URL to filepath. Returns (success, error_message)."""
     if not url:
         return False, "No URL provided"
     
     try:
-        print(f"  Downloading: {url[:80]}...")
-        r = requests.get(url, headers=UA, timeout=timeout, stream=True)
-        r.raise_for_status()
-        
-        # Write in chunks to handle large files
-        with open(filepath, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+        log.debug("  Downloading: %s...", url[:80])
+        async with client.stream("GET", url, timeout=timeout) as r:
+            r.raise_for_status()
+            
+            # Stream in chunks to handle large files. Each write (a syscall
+            # plus a thread hop) moves a full WRITE_BATCH, and raw fd writes
+            # skip the BufferedWriter copy. Bodies that need no decoding go
+            # through a reused buffer; encoded ones are re-chunked by httpx.
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                if r.headers.get("content-encoding", "identity") == "identity":
+                    await save_raw(r, fd)
+                else:
+                    async for chunk in r.aiter_bytes(WRITE_BATCH):
+                        await asyncio.to_thread(write_all, fd, chunk)
+            finally:
+                os.close(fd)
         
         file_size = filepath.stat().st_size
-        print(f"  ✓ Saved: {filepath.name} ({file_size:,} bytes)")
+        if file_size >= LARGE_FILE_BYTES:
+            await asyncio.to_thread(drop_page_cache, filepath)
+        log.debug("  ✓ Saved: %s (%s bytes)", filepath.name, f"{file_size:,}")
         return True, ""
         
-    except requests.RequestException as e:
-        error_msg = f"{type(e).__name__}: {str(e)[:100]}"
-        print(f"  ✗ Failed: {error_msg}")
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError) as e:
+        # InvalidURL and idna's ValueError subclasses come from malformed CSV
+        # URLs; record them as failures rather than aborting the run
+        # httpx appends a multi-line docs hint to status errors; keep the first line
+        first_line = str(e).partition("\n")[0]
+        error_msg = f"{type(e).__name__}: {first_line[:100]}"
+        log.warning("  ✗ Failed: %s", error_msg)
         # Remove partial download
         if filepath.exists():
             filepath.unlink()
         return False, error_msg
 
+async def _download_all(jobs: list, stats: dict, on_failure, max_downloads: int = None):
+    """Run download jobs concurrently, bounded by MAX_CONCURRENCY."""
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    # HTTP/2 multiplexes a host's downloads over one connection, so politeness
+    # per host is enforced here rather than by the connection pool
+    host_sems = defaultdict(lambda: asyncio.Semaphore(MAX_PER_HOST))
+    limits = httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+    # With a download limit, only start as many jobs as could still count
+    # towards it; the rest wait to see whether in-flight downloads succeed
+    budget = asyncio.Condition()
+    in_flight = 0
+    done = 0
+    
+    def limit_reached():
+        return max_downloads and stats["downloaded"] >= max_downloads
+    
+    async def run(url, filepath, failure):
+        nonlocal in_flight
+        async with sem:
+            async with budget:
+                await budget.wait_for(lambda: not max_downloads or limit_reached()
+                                      or stats["downloaded"] + in_flight < max_downloads)
+                if limit_reached():
+                    return
+                in_flight += 1
+            async with host_sems[urlparse(url).hostname]:
+                success, error_msg = await download_file(client, url, filepath)
+            async with budget:
+                in_flight -= 1
+                if success:
+                    stats["downloaded"] += 1
+                else:
+                    stats["failed"] += 1
+                    on_failure(failure | {"error": error_msg})
+                budget.notify_all()
+    
+    async def tracked(job):
+        nonlocal done
+        await run(*job)
+        done += 1
+        if done % PROGRESS_EVERY == 0 or done == len(jobs):
+            log.info("Progress: %d/%d jobs (%d downloaded, %d failed)",
+                     done, len(jobs), stats["downloaded"], stats["failed"])
+    
+    async with httpx.AsyncClient(http2=True, headers=UA, limits=limits, follow_redirects=True) as client:
+        await asyncio.gather(*(tracked(job) for job in jobs))
+
 def download_documents(csv_path: str = "local_plan_documents_clean.csv", 
                        max_downloads: int = None,
                        skip_existing: bool = True,
@@ -89,7 +215,7 @@ def download_documents(csv_path: str = "local_plan_documents_clean.csv",
     """
     
     if not os.path.exists(csv_path):
-        print(f"Error: CSV file not found: {csv_path}")
+        log.error("Error: CSV file not found: %s", csv_path)
         return
     
     stats = {
@@ -101,75 +227,104 @@ def download_documents(csv_path: str = "local_plan_documents_clean.csv",
         "failed": 0,
     }
     
-    failed_downloads = []
+    jobs = []
+    queued = set()
+    created_dirs = set()
+    # One directory walk up front instead of a stat() per row
+    existing = ({Path(root) / name for root, _, files in os.walk(DOWNLOAD_DIR) for name in files}
+                if skip_existing else set())
     
     with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader, [])
+        missing = [c for c in REQUIRED_COLUMNS if c not in header]
+        if missing:
+            log.error("Error: CSV is missing columns: %s", ", ".join(missing))
+            return
+        # Absent optional columns are read from a tail of defaults appended
+        # to each row, so one itemgetter still pulls every field in a C call
+        width = len(header)
+        absent = [c for c in CSV_COLUMNS if c not in header]
+        tail = [CSV_DEFAULTS[c] for c in absent]
+        index = {c: header.index(c) for c in CSV_COLUMNS if c in header}
+        index.update((c, width + i) for i, c in enumerate(absent))
+        pick = itemgetter(*(index[c] for c in CSV_COLUMNS))
         
         for row in reader:
+            # Blank lines come through as []; DictReader used to skip them
+            if not row:
+                continue
+            # Pad short rows (and trim long ones) to the header width
+            if len(row) != width or tail:
+                row = row[:width] + [""] * (width - len(row)) + tail
             stats["total"] += 1
+            final_url, landing_url, file_kind, doc_ref, doc_name, local_plan, lpa_curie, lpa_name = pick(row)
             
             # Get the file URL (prefer final_url, fallback to landing_url)
-            url = row.get("final_url", "").strip()
-            if not url:
-                url = row.get("landing_url", "").strip()
+            url = final_url.strip() or landing_url.strip()
             
             if not url:
                 stats["skipped_no_url"] += 1
                 continue
             
             # Filter by file kind if specified
-            file_kind = row.get("file_kind", "")
             if file_kinds and file_kind not in file_kinds:
                 stats["skipped_kind"] += 1
                 continue
             
-            # Generate filename
-            doc_ref = row.get("doc_reference", "unknown")
-            doc_name = row.get("doc_name", "document")
-            local_plan = row.get("local_plan", "")
-            
-            # Create subdirectory for each local plan
-            if local_plan:
-                plan_dir = DOWNLOAD_DIR / sanitize_filename(local_plan)
-                plan_dir.mkdir(exist_ok=True)
-            else:
-                plan_dir = DOWNLOAD_DIR / "uncategorized"
+            # Create subdirectory for each local plan (once per directory)
+            plan_dir = DOWNLOAD_DIR / (sanitize_filename(local_plan) if local_plan else "uncategorized")
+            if plan_dir not in created_dirs:
                 plan_dir.mkdir(exist_ok=True)
+                created_dirs.add(plan_dir)
             
             filename = get_filename_from_url(url, doc_ref, doc_name, file_kind)
             filepath = plan_dir / filename
             
-            # Skip if already exists
-            if skip_existing and filepath.exists():
-                print(f"[{stats['total']}] Skipping existing: {filepath.name}")
+            # Skip if already exists (or is already queued by an earlier row)
+            if filepath in queued or filepath in existing:
+                log.debug("[%d] Skipping existing: %s", stats["total"], filepath.name)
                 stats["skipped_exists"] += 1
                 continue
             
-            # Download
-            print(f"[{stats['total']}] {doc_ref}: {doc_name[:60]}")
-            success, error_msg = download_file(url, filepath)
-            if success:
-                stats["downloaded"] += 1
-            else:
-                stats["failed"] += 1
-                failed_downloads.append({
-                    "doc_reference": doc_ref,
-                    "doc_name": doc_name,
-                    "url": url,
-                    "error": error_msg,
-                    "lpa_curie": row.get("lpa_curie", ""),
-                    "lpa_name": row.get("lpa_name", ""),
-                    "local_plan": local_plan,
-                })
-            
-            # Check if we've hit the download limit
-            if max_downloads and stats["downloaded"] >= max_downloads:
-                print(f"\nReached download limit of {max_downloads}")
-                break
-            
-            # Rate limiting
-            time.sleep(0.5)
+            log.debug("[%d] %s: %s", stats["total"], doc_ref, doc_name[:60])
+            queued.add(filepath)
+            jobs.append((url, filepath, {
+                "doc_reference": doc_ref,
+                "doc_name": doc_name,
+                "url": url,
+                "error": "",
+                "lpa_curie": lpa_curie,
+                "lpa_name": lpa_name,
+                "local_plan": local_plan,
+            }))
+    
+    # Failures are written as they happen so a killed run keeps its log
+    fail_fp = None
+    fail_writer = None
+    
+    def log_failure(failure: dict):
+        nonlocal fail_fp, fail_writer
+        if not log_failures:
+            return
+        if fail_writer is None:
+            fail_fp = open(FAILURES_LOG, 'w', newline='', encoding='utf-8')
+            fail_writer = csv.DictWriter(fail_fp, fieldnames=FAILURE_FIELDS)
+            fail_writer.writeheader()
+        fail_writer.writerow(failure)
+        fail_fp.flush()
+    
+    # Download concurrently; per-host politeness comes from host_sems in _download_all
+    try:
+        asyncio.run(_download_all(jobs, stats, log_failure, max_downloads))
+    finally:
+        if fail_fp is not None:
+            fail_fp.close()
+    # Write out buffered row records so they precede the summary
+    for handler in log.handlers:
+        handler.flush()
+    if max_downloads and stats["downloaded"] >= max_downloads:
+        print(f"\nReached download limit of {max_downloads}")
     
     # Print summary
     print("\n" + "="*60)
@@ -182,18 +337,12 @@ def download_documents(csv_path: str = "local_plan_documents_clean.csv",
     print(f"  Failed downloads: {stats['failed']}")
     print(f"\nFiles saved to: {DOWNLOAD_DIR.absolute()}")
     
-    # Write failures log
-    if log_failures and failed_downloads:
-        failures_log = "download_failures.csv"
-        with open(failures_log, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=failed_downloads[0].keys())
-            writer.writeheader()
-            writer.writerows(failed_downloads)
-        print(f"Failed downloads logged to: {failures_log}")
+    if fail_fp is not None:
+        print(f"Failed downloads logged to: {FAILURES_LOG}")
     
     print("="*60)
     
-    return stats, failed_downloads
+    return stats
 
 if __name__ == "__main__":
     import argparse
@@ -207,9 +356,18 @@ if __name__ == "__main__":
                        help="Re-download files that already exist")
     parser.add_argument("--kinds", nargs="+", 
                        help="Only download specific file kinds (e.g., --kinds pdf)")
+    parser.add_argument("--verbose", action="store_true",
+                       help="Log every row and download, not just progress")
     
     args = parser.parse_args()
     
+    # Per-row debug records are buffered and written in batches; progress
+    # (INFO) and failures flush the buffer so output stays in order
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(MemoryHandler(capacity=1024, flushLevel=logging.INFO, target=stream))
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    
     download_documents(
         csv_path=args.csv,
         max_downloads=args.max,
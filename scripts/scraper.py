@@ -1,4 +1,7 @@
-import csv, time, mimetypes, requests
+import asyncio, csv, json, shelve, time, mimetypes, requests
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urlparse
 
 BASE = "https://www.planning.data.gov.uk/entity.json"
@@ -11,6 +14,31 @@ SPLIT_FIX = {
 }
 
 UA = {"User-Agent": "TPA-harvester/1.0 (+planning use)"}
+CLASSIFY_CONCURRENCY = 12
+PAGE_CONCURRENCY = 4
+CLASSIFY_CACHE_TTL = 30 * 24 * 3600
+ORG_CONCURRENCY = 10
+# Retry policy shared by SESSION and the aiohttp entity-API pager
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+ORG_CACHE_PATH = "org_cache.json"
+# Map/document viewers; their links are landing pages, not files
+VIEWER_HOSTS = ("arcgis.com","maps.arcgis.com","sharepoint.com","google.com","drive.google.com")
+# Extensions unambiguous enough to classify without a HEAD request
+EXT_TO_KIND = {"pdf": "pdf", "doc": "doc", "docx": "doc", "html": "html", "htm": "html",
+               "jpg": "image", "png": "image"}
+
+# url -> (checked_at, classify_url result), persisted across runs. Network
+# failures and 4xx/5xx responses are not stored so they are retried next time.
+CACHE = shelve.open("classify_cache.db")
+
+# Shared keep-alive pool for organisation lookups
+SESSION = requests.Session()
+SESSION.headers.update(UA)
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                      max_retries=Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF,
+                                                        status_forcelist=RETRY_STATUSES)))
 
 def fix_types(s: str) -> list[str]:
     if not s: return []
@@ -20,79 +48,157 @@ def fix_types(s: str) -> list[str]:
         fixed.append(SPLIT_FIX.get(p, p))
     return sorted(set(fixed))
 
-def fetch_docs(limit=500):
-    params = {"dataset":"local-plan-document","field":FIELDS,"limit":limit,"offset":0}
-    while True:
-        r = requests.get(BASE, params=params, headers=UA, timeout=60)
-        r.raise_for_status()
-        data = r.json()
-        items = data.get("entities", [])
-        if not items: break
-        for it in items: yield it
-        params["offset"] += params["limit"]; time.sleep(0.2)
-
-org_cache = {}
+async def fetch_docs(limit=500):
+    # Request PAGE_CONCURRENCY pages at a time and stop at the first empty one
+    sem = asyncio.Semaphore(PAGE_CONCURRENCY)
+    async with aiohttp.ClientSession(headers=UA) as session:
+        async def page(offset):
+            params = [("dataset","local-plan-document"), *(("field", f) for f in FIELDS),
+                      ("limit", str(limit)), ("offset", str(offset))]
+            async with sem:
+                # Retry throttling, 5xx and dropped connections like SESSION
+                # does, honouring Retry-After (in seconds) when given
+                for attempt in range(RETRY_TOTAL + 1):
+                    delay = RETRY_BACKOFF * 2 ** attempt
+                    try:
+                        async with session.get(BASE, params=params, timeout=aiohttp.ClientTimeout(total=60)) as r:
+                            if r.status not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                                r.raise_for_status()
+                                data = await r.json(content_type=None)
+                                return data.get("entities", [])
+                            retry_after = r.headers.get("Retry-After", "")
+                            if retry_after.isdigit():
+                                delay = int(retry_after)
+                    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                        if attempt == RETRY_TOTAL: raise
+                    await asyncio.sleep(delay)
+
+        docs = []
+        offset = 0
+        while True:
+            pages = await asyncio.gather(*(page(offset + i * limit) for i in range(PAGE_CONCURRENCY)))
+            for items in pages:
+                if not items: return docs
+                docs.extend(items)
+            offset += PAGE_CONCURRENCY * limit
+
+ORG_URL = "https://www.planning.data.gov.uk/entity/{}.json"
+
+def org_record(j: dict) -> dict:
+    curie = f"{j.get('prefix','')}:{j.get('reference','')}".strip(":")
+    return {"lpa_curie":curie, "lpa_name":j.get("name","")}
+
+# entity id -> org record, persisted across runs
+try:
+    with open(ORG_CACHE_PATH, encoding="utf-8") as f:
+        org_cache = json.load(f)
+except FileNotFoundError:
+    org_cache = {}
+
 def resolve_org(entity_id: str):
     if not entity_id: return {"lpa_curie":"", "lpa_name":""}
     if entity_id in org_cache: return org_cache[entity_id]
-    r = requests.get(f"https://www.planning.data.gov.uk/entity/{entity_id}.json",
-                     headers=UA, timeout=30)
+    r = SESSION.get(ORG_URL.format(entity_id), timeout=30)
     r.raise_for_status()
-    j = r.json()
-    curie = f"{j.get('prefix','')}:{j.get('reference','')}".strip(":")
-    org_cache[entity_id] = {"lpa_curie":curie, "lpa_name":j.get("name","")}
+    org_cache[entity_id] = org_record(r.json())
     time.sleep(0.1)
     return org_cache[entity_id]
 
-def classify_url(u: str):
+async def prefetch_orgs(entity_ids):
+    # Resolve uncached organisations in one concurrent burst; failures are
+    # left for resolve_org to retry through the pooled session
+    sem = asyncio.Semaphore(ORG_CONCURRENCY)
+    async with aiohttp.ClientSession(headers=UA) as session:
+        async def one(entity_id):
+            async with sem:
+                try:
+                    async with session.get(ORG_URL.format(entity_id), timeout=aiohttp.ClientTimeout(total=30)) as r:
+                        r.raise_for_status()
+                        org_cache[entity_id] = org_record(await r.json(content_type=None))
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+        await asyncio.gather(*(one(e) for e in entity_ids))
+
+async def classify_url(session: aiohttp.ClientSession, u: str):
     if not u: return ("", "", 0, "unknown")
     # Quick guard: treat obvious viewers/apps as landing
-    host = urlparse(u).hostname or ""
-    viewer_hosts = ("arcgis.com","maps.arcgis.com","sharepoint.com","google.com","drive.google.com")
-    if any(host.endswith(h) for h in viewer_hosts):
+    p = urlparse(u)
+    host = p.hostname or ""
+    if host.endswith(VIEWER_HOSTS):
         return (u, "", 0, "landing")
-    ext = (urlparse(u).path or "").lower()
+    ext = (p.path or "").lower()
     guessed = mimetypes.guess_type(ext)[0] or ""
+    # Trust a plain file extension; query strings may mean a script serving anything
+    kind = None if p.query else EXT_TO_KIND.get(ext.rpartition(".")[2])
+    if kind:
+        return (u, guessed, 200, kind)
+    # Reuse classifications from earlier runs until they go stale
+    hit = CACHE.get(u)
+    if hit is not None and time.time() - hit[0] < CLASSIFY_CACHE_TTL:
+        return hit[1]
     try:
-        h = requests.head(u, headers=UA, allow_redirects=True, timeout=25)
-        status = h.status_code
-        ctype = h.headers.get("Content-Type","").split(";")[0].strip().lower()
-        final = h.url
+        async with session.head(u, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=25)) as h:
+            status = h.status
+            ctype = h.headers.get("Content-Type","").split(";")[0].strip().lower()
+            final = str(h.url)
         # Fallback tiny GET if HEAD blocked
         if status >= 400 or (not ctype):
-            g = requests.get(u, headers=UA|{"Range":"bytes=0-0"}, allow_redirects=True, timeout=30)
-            status = g.status_code
-            ctype = g.headers.get("Content-Type","").split(";")[0].strip().lower()
-            final = g.url
-    except requests.RequestException:
+            async with session.get(u, headers={"Range":"bytes=0-0"}, allow_redirects=True,
+                                   timeout=aiohttp.ClientTimeout(total=30)) as g:
+                status = g.status
+                ctype = g.headers.get("Content-Type","").split(";")[0].strip().lower()
+                final = str(g.url)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         return (u, "", 0, "unknown")
     file_kind = ("pdf" if "pdf" in ctype or ext.endswith(".pdf")
                  else "image" if ctype.startswith("image/")
                  else "html" if "html" in ctype
                  else "doc" if ctype.startswith("application/")
                  else "unknown")
-    return (final, ctype, status, file_kind)
+    result = (final, ctype, status, file_kind)
+    # Throttled (429) and error responses are retried next run, not cached
+    if 0 < status < 400:
+        CACHE[u] = (time.time(), result)
+    return result
 
-seen = set()
-rows = []
+async def classify_all(urls: list[str]):
+    # One session so connections are kept alive; the semaphore bounds in-flight checks
+    sem = asyncio.Semaphore(CLASSIFY_CONCURRENCY)
+    async with aiohttp.ClientSession(headers=UA) as session:
+        async def one(u):
+            async with sem:
+                return await classify_url(session, u)
+        return await asyncio.gather(*(one(u) for u in urls))
+
+docs = asyncio.run(fetch_docs())
+org_ids = {str(d.get("organisation-entity","")).strip() for d in docs} - {""} - org_cache.keys()
+if org_ids:
+    print(f"Resolving {len(org_ids)} organisations...")
+    asyncio.run(prefetch_orgs(org_ids))
+
+# key -> (doc, org); setdefault keeps the first occurrence with one hash lookup
+unique = {}
 doc_count = 0
-for d in fetch_docs():
+for d in docs:
     doc_count += 1
     if doc_count % 10 == 0:
-        print(f"Processed {doc_count} documents, {len(rows)} unique rows...")
+        print(f"Processed {doc_count} documents, {len(unique)} unique rows...")
     
     org = resolve_org(str(d.get("organisation-entity","")).strip())
-    doc_types = fix_types(d.get("document-types",""))
     key = (org["lpa_curie"], d.get("local-plan",""), d.get("document-url",""))
-    if key in seen: continue
-    seen.add(key)
+    unique.setdefault(key, (d, org))
+pending = list(unique.values())
 
-    file_url = d.get("document-url","").strip()
-    landing_url = d.get("documentation-url","").strip()
+print(f"Classifying {len(pending)} URLs...")
+classified = asyncio.run(classify_all([d.get("document-url","").strip() for d, _ in pending]))
+CACHE.close()
+with open(ORG_CACHE_PATH, "w", encoding="utf-8") as f:
+    json.dump(org_cache, f)
 
-    if doc_count % 10 == 1:  # Print for first in batch
-        print(f"  Classifying URL: {file_url[:60]}...")
-    final_url, ctype, status, file_kind = classify_url(file_url)
+rows = []
+for (d, org), (final_url, ctype, status, file_kind) in zip(pending, classified):
+    doc_types = fix_types(d.get("document-types",""))
+    landing_url = d.get("documentation-url","").strip()
 
     # If it's not an actual document, demote to landing_url
     if file_kind in ("landing","html","unknown") and landing_url:
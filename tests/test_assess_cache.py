@@ -0,0 +1,46 @@
+from fastapi.testclient import TestClient
+
+from app.main import app, _ASSESS_CACHE
+
+client = TestClient(app)
+
+
+def _envelope(case_id: str, site_id: str, **extra) -> dict:
+    return {
+        "schema": "tpa.run/0.3",
+        "case": {"id": case_id, "type": "householder"},
+        "site": {"id": site_id, "geometry": {"type": "Point", "coordinates": [0, 51]}},
+        **extra,
+    }
+
+
+def test_client_run_id_cannot_read_another_envelopes_cached_result():
+    _ASSESS_CACHE.clear()
+    a = client.post("/assess", json=_envelope("case-a", "site-a"))
+    assert a.headers["X-Cache"] == "miss"
+    inputs_hash = a.json()["trace"]["inputs_hash"]
+
+    # A different envelope that names A's hash as its client_run_id
+    b = client.post("/assess", json=_envelope("case-b", "site-b", client_run_id=inputs_hash))
+    assert b.status_code == 200
+    assert b.headers["X-Cache"] == "miss"
+    assert b.content != a.content
+    assert b.headers["X-Run-Id"] in b.json()["artifacts"]["site_map"]["uri"]
+
+
+def test_repeated_envelope_is_served_from_cache():
+    _ASSESS_CACHE.clear()
+    env = _envelope("case-c", "site-c")
+    first = client.post("/assess", json=env)
+    second = client.post("/assess", json=env)
+    assert second.headers["X-Cache"] == "hit"
+    assert second.content == first.content
+
+
+def test_client_run_ids_sharing_a_prefix_get_distinct_run_ids():
+    ids = ["tenant-a-run-000001", "tenant-a-run-000002"]
+    run_ids = [
+        client.post("/runs", json=_envelope("case-d", "site-d", client_run_id=i)).headers["X-Run-Id"]
+        for i in ids
+    ]
+    assert run_ids == ids